@@ -1,20 +1,25 @@
 import os
 import sys
 import fcntl
+import hashlib
 import tempfile
 import subprocess
-from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from shutil import copyfileobj, rmtree
 from typing import Any, IO, Iterator
 import argparse
 import glob
 import re
+import pickle
 import signal
+import time
 from urllib.parse import unquote, urlparse, parse_qs
 from pathlib import Path
 
 import rpm
-from urpm import Pack
+from urpm import Pack, BUFSIZE, PACKAGE_INFO_VERSION, get_package_info, parse_filter
 
 
 __version__ = "3.00"
@@ -22,7 +27,7 @@ __version__ = "3.00"
 def main():
     parser = argparse.ArgumentParser(description='Create a hdlist and associated media info from a directory of RPMs.')
     parser.add_argument('rpms_dir', nargs="?", help='directory containing *.rpm files')
-    parser.add_argument('--clean', action='store_true', help='do not use incremental updates')
+    parser.add_argument('--clean', action='store_true', help='do not use incremental updates nor the cache of rpm headers')
     parser.add_argument('--no-bad-rpm', action='store_true', help='do not fail on bad rpm')
     parser.add_argument('--no-md5sum', action='store_true', help='do not generate MD5SUM')
     parser.add_argument('--no-clean-old-rpms', action='store_true', help='do not clean old rpms. Ignored for now')
@@ -31,11 +36,13 @@ def main():
     parser.add_argument('--no-hdlist', action='store_true', help='do not generate hdlist.cz')
     parser.add_argument('--allow-empty-media', action='store_true', help='allow empty media')
     parser.add_argument('--file-deps', metavar='FILE', help='use file_deps.lst file')
-    parser.add_argument('--hdlist-filter', metavar='FILTER', default=b".cz:gzip -9", help="use FILTER to compress hdlist, default: .cz:gzip -9")
-    parser.add_argument('--synthesis-filter', metavar='FILTER', default=b".cz:xz -7", help="use FILTER to compress synthesis.hdlist, default: .cz:xz -7")
+    parser.add_argument('--hdlist-filter', metavar='FILTER', default=".cz:gzip -9", help="use FILTER to compress hdlist, default: .cz:gzip -9")
+    parser.add_argument('--synthesis-filter', metavar='FILTER', default=".cz:xz -7", help="use FILTER to compress synthesis.hdlist (gzip, xz or zstd), default: .cz:xz -7")
     parser.add_argument('--xml-info', action='store_true', help='Force to generate xml info. By default genhdlist3 will only regenerate xml info files already there in media_info')
-    parser.add_argument('--xml-info-filter', metavar='FILTER', default=b".lzma:xz -7", help='use FILTER to compress XML media info, default: .lzma:xz -7')
+    parser.add_argument('--xml-info-filter', metavar='FILTER', default=".lzma:xz -7", help='use FILTER to compress XML media info (gzip, xz or zstd), default: .lzma:xz -7')
     parser.add_argument('--versioned', action='store_true', help='generate versioned media info, default: no')
+    parser.add_argument('--header-cache', metavar='FILE', help='file caching the parsed rpm headers between runs (default: in $XDG_CACHE_HOME/upanier)')
+    parser.add_argument('--no-header-cache', action='store_true', help='do not cache the parsed rpm headers')
     parser.add_argument('--media-info-dir', metavar='DIR', help='directory containing media info files (default: %(rpms_dir)s/media_info)')
     parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
     parser.add_argument('--version', action='store_true', help='print version and exit')
@@ -74,6 +81,13 @@ def main():
             
     if args.media_info_dir is None:
         media_info_dir = Path(rpms_dir) / "media_info"
+    else:
+        media_info_dir = Path(args.media_info_dir)
+    tmp_dir = media_info_dir / "tmp"
+    if args.no_header_cache:
+        header_cache = None
+    else:
+        header_cache = Path(args.header_cache) if args.header_cache else default_header_cache(rpms_dir)
     if not media_info_dir.exists():
         # create the directory, if possible
          media_info_dir.mkdir(parents=True, exist_ok=True)
@@ -88,30 +102,38 @@ def main():
                 sys.exit(1)
             raise
 
-    rpms = [f for f in Path(rpms_dir).glob("*.rpm")]
-    rpms.sort()
-    rpms = [os.path.join(rpms_dir, f) for f in rpms]
-    if not rpms and not args.allow_empty_media:
+    # sorted basenames, the order of the hdlist must be deterministic
+    with os.scandir(rpms_dir) as it:
+        rpms_todo = dict.fromkeys(sorted(e.name for e in it if e.name.endswith(".rpm")))
+    if not rpms_todo and not args.allow_empty_media:
         print(f"no *.rpm files found in {rpms_dir}, use --allow-empty-media to proceed (or specify a valid rpms_dir)")
         sys.exit(1)
 
     versioned = args.versioned
 
     xml_info = args.xml_info or (media_info_dir / 'info.xml.lzma').exists()
-    if not args.hdlist_filter.decode("utf-8").startswith('.'):
+    if not args.hdlist_filter.startswith('.'):
         raise Exception("hdlist_filter must start with '.' followed by an extension then ':' as separator for a filter including a compression level from -0 to -9 (e.g. .cz:gzip -9)")
-    hdlist_filename = 'hdlist' + args.hdlist_filter.decode("utf-8").split(":")[0]
-    synthesis_filename = f'synthesis.hdlist{args.synthesis_filter.decode("utf-8").split(":")[0]}'
+    # filters are parsed once, as (suffix, tool, level)
+    hdlist_filter = parse_filter(args.hdlist_filter)
+    synthesis_filter = parse_filter(args.synthesis_filter)
+    xml_info_filter = parse_filter(args.xml_info_filter)
+    hdlist_filename = 'hdlist' + hdlist_filter[0]
+    synthesis_filename = 'synthesis.hdlist' + synthesis_filter[0]
     media_info_files = [hdlist_filename, synthesis_filename] if not args.no_hdlist else []
-    media_info_files.extend(f'{f}.xml{args.xml_info_filter.decode("utf-8").split(":")[0]}' for f in ['info', 'files', 'changelog'] if xml_info)
+    media_info_files.extend(f'{f}.xml{xml_info_filter[0]}' for f in ['info', 'files', 'changelog'] if xml_info)
     xml_media_info = ['info', 'files', 'changelog'] if xml_info else []
     # we don't provide anymore other option
     output_recommends = True
 
-    if not args.nolock:
-        lock = lock_file(Path(media_info_dir) / 'UPDATING')
-        signal.signal(signal.SIGINT, lambda signum, frame: cleanup(lock, media_info_dir))
-        signal.signal(signal.SIGTERM, lambda signum, frame: cleanup(lock, media_info_dir))
+    # holds the lock of media_info_dir until the end of main
+    lock = ExitStack()
+    if not args.nolock and is_network_fs(media_info_dir):
+        print(f"{media_info_dir} is on a network filesystem, not locking it")
+    elif not args.nolock:
+        lock.enter_context(lock_file(media_info_dir / 'UPDATING'))
+        signal.signal(signal.SIGINT, lambda signum, frame: (lock.close(), sys.exit(1)))
+        signal.signal(signal.SIGTERM, lambda signum, frame: (lock.close(), sys.exit(1)))
 
     # Force locale to be C
     # We don't translate anything but we would get translated package info and
@@ -127,8 +149,6 @@ def main():
             clean_old_rpms(rpms_dir, old_rpms)
             write_old_rpms_lst(old_rpms, old_rpms_file)"""
 
-    rpms_todo = {os.path.basename(f): None for f in rpms}
-
 
     if file_deps:
         print("--file_deps: This option is not yet managed")
@@ -138,14 +158,12 @@ def main():
             with open(file, 'r') as f:
                 for line in f:
                     urpm.add_provide(unquote(line.strip()))
-    synthesis_suffix, synthesis_filter = args.synthesis_filter.split(b":")
-    xml_info_suffix, xml_info_filter = args.xml_info_filter.split(b":")
-
-    synthesis = (media_info_dir / "tmp" / 'synthesis.hdlist').with_suffix(synthesis_suffix.decode("utf-8"))
+    synthesis = tmp_dir / synthesis_filename
 
     if not args.no_hdlist:
         # out_hdlist = gzip.open(hdlist_file.with_suffix(".tmp"), "wb", compresslevel=9)
-        out_hdlist = Pack(Path(media_info_dir) /"tmp" / hdlist_filename, synthesis, args.hdlist_filter)
+        out_hdlist = Pack(tmp_dir / hdlist_filename, synthesis, hdlist_filter,
+                          synthesis_filter=synthesis_filter, xml_info_filter=xml_info_filter)
 
     out = {
         "hdlist": out_hdlist,
@@ -154,42 +172,41 @@ def main():
     if Path(hdlist_filename).exists() and incremental:
         print(f"Filtering {hdlist_file} into {hdlist_file.with_suffix('.tmp')} : not ready, skipping")
 
-    add_new_rpms_to_hdlist(rpms_todo, out, rpms_dir, xml_media_info, xml_info_suffix)
+    add_new_rpms_to_hdlist(rpms_todo, out, rpms_dir, xml_media_info,
+                           header_cache=header_cache, clean=args.clean)
 
-    for name in media_info_files:
+    moves = [(tmp_dir / name, media_info_dir / name) for name in media_info_files]
+    for src, dst in moves:
         if verbose:
-            print(f"moving {name}")
-        src = (Path(media_info_dir) / "tmp" / name)
-        dst = (Path(media_info_dir) / name)
+            print(f"moving {dst.name}")
         if src.exists():
             src.replace(dst)
         elif not dst.exists():
             if verbose:
                 print(f"{src} doesn't exist, skipping")
             continue
-    (Path(media_info_dir) / "tmp").rmdir()
+    tmp_dir.rmdir()
 
 
 
     if not args.no_md5sum:
-        md5sum_path = Path(media_info_dir) / 'MD5SUM'
+        md5sum_path = media_info_dir / 'MD5SUM'
         md5sum_path.unlink(missing_ok=True)
-        import hashlib
 
     if versioned:
-        if versioned != 'auto' or (Path(media_info_dir) / 'versioned-media-info').exists():
+        if versioned != 'auto' or (media_info_dir / 'versioned-media-info').exists():
             import datetime
             import time
             version = datetime.datetime.fromtimestamp(time.time()).strftime("%Y%m%d-%H%M%S")
 
     if not args.no_md5sum:
-            f = open(Path(media_info_dir) / 'MD5SUM', 'w')
+            f = open(md5sum_path, 'w')
             if verbose:
                 print(f"creating MDSUM file")
 
-    for file in media_info_files:
+    md5sum_todo = []
+    for file, (_, src) in zip(media_info_files, moves):
         name = file
-        src = media_info_dir / file
         if versioned:
             # renaming file with a prefix in the form of YYYYMMDD-HHMMSS
             name = f"{version}-{file}"
@@ -201,15 +218,29 @@ def main():
             dst = src
         # adding md5sum for each file if required
         if not args.no_md5sum:
-            if os.path.exists(dst):
-                with open(dst, 'rb') as h:
-                    md5 = hashlib.md5()
-                    while chunk := h.read(8192):
-                        md5.update(chunk)
-                    f.write(f"{md5.hexdigest()}  {name}\n")
+            if dst.exists():
+                md5sum_todo.append((name, dst))
             else:
                 print(f"{name} doesn't exist, skipping")
 
+    if not args.no_md5sum:
+        # hashlib releases the GIL, so the files can be hashed in threads
+        with ThreadPoolExecutor(max_workers=len(md5sum_todo) or 1) as executor:
+            digests = executor.map(md5sum, [dst for _, dst in md5sum_todo])
+            for (name, _), digest in zip(md5sum_todo, digests):
+                f.write(f"{digest}  {name}\n")
+        f.close()
+
+    lock.close()
+
+def md5sum(file):
+    with open(file, 'rb', buffering=BUFSIZE) as h:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(h, 'md5').hexdigest()
+        md5 = hashlib.md5()
+        while chunk := h.read(1 << 20):
+            md5.update(chunk)
+        return md5.hexdigest()
 
 @contextmanager
 def lock_file(file):
@@ -225,26 +256,79 @@ def lock_file(file):
         fcntl.flock(lock, fcntl.LOCK_UN)
     os.remove(file)
 
-def cleanup( media_info_dir):
-    os.remove(media_info_dir / self.hdlist_filename.with_suffix('.tmp'))
-    os.remove(media_info_dir / self.synthesis_filename.with_suffix('.tmp'))
-        
+def is_network_fs(path):
+    # flock is not reliable on network filesystems, find the filesystem of path in /proc/mounts
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    try:
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                _, point, point_fs_type = line.split()[:3]
+                # spaces and the like are written as octal escapes, \040 for a space
+                point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), point)
+                # the last of several filesystems mounted on the same point is the visible one
+                if (path == point or path.startswith(point.rstrip('/') + '/')) and len(point) >= len(mount_point):
+                    mount_point, fs_type = point, point_fs_type
+    except OSError:
+        return False
+    return fs_type.startswith(("nfs", "cifs", "smb"))
+
+# parsed old-rpms.lst files, by path, with their mtime
+_old_rpms_cache = {}
+
+def _fast_parse_old_rpms(file):
+    # old-rpms.lst only holds [Section] lines and "pkg = timestamp" lines,
+    # anything else raises ValueError so that configparser handles it
+    sections = {}
+    section = None
+    with open(file, 'r') as f:
+        for line in f:
+            indented = line[:1].isspace()
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if indented:
+                # a continuation of the previous value for configparser
+                raise ValueError(f"unexpected indented line in {file}: {line}")
+            if line[0] == '[' and line[-1] == ']':
+                section = sections.setdefault(line[1:-1], {})
+                continue
+            key, sep, value = line.partition('=')
+            key = key.strip()
+            if section is None or not sep or key in section:
+                raise ValueError(f"unexpected line in {file}: {line}")
+            section[key] = value.strip()
+    return sections
 
 def read_old_rpms_lst(file, nolock):
     import configparser
 
-    config = configparser.ConfigParser()
     if not Path(file).exists():
         return None
 
     lock = lock_file(file + '.lock') if not nolock else None
 
-    try:
-        config.read(file)
-    except configparser.DuplicateOptionError:
-        print("duplicate option in", file)
-        return None
-
+    mtime = os.stat(file).st_mtime_ns
+    cached = _old_rpms_cache.get(file)
+    if cached and cached[0] == mtime:
+        sections = cached[1]
+    else:
+        try:
+            sections = _fast_parse_old_rpms(file)
+        except ValueError:
+            config = configparser.ConfigParser()
+            # keep the case of the package names, as the fast path does
+            config.optionxform = str
+            try:
+                config.read(file)
+            except configparser.DuplicateOptionError:
+                print("duplicate option in", file)
+                return None
+            sections = {name: dict(config[name]) for name in config.sections()}
+        _old_rpms_cache[file] = (mtime, sections)
+
+    # callers remove entries, keep the cached copy intact
+    config = {name: dict(section) for name, section in sections.items()}
     return {'lst': config, 'lock': lock}
 
 def write_old_rpms_lst(old_rpms, file):
@@ -252,6 +336,7 @@ def write_old_rpms_lst(old_rpms, file):
 
     if old_rpms['lock']:
         config = configparser.ConfigParser()
+        config.optionxform = str
         config.read_dict({'Remove': dict(old_rpms['lst']['Remove'])})
         with open(file, 'w') as f:
             config.write(f)
@@ -262,10 +347,11 @@ def write_old_rpms_lst(old_rpms, file):
 
 def clean_old_rpms(rpms_dir, old_rpms):
     config = old_rpms['lst']
-    for pkg in config['Remove']:
+    # entries are deleted along the way, iterate over a copy of the names
+    for pkg in list(config['Remove']):
         src = os.path.join(rpms_dir, pkg)
+        date = config['Remove'][pkg]
         if os.path.exists(src):
-            date = config['Remove'][pkg]
             if int(date) >= int(time.time()):
                 print(f"[OLD-RPMS] keeping {pkg} (it is scheduled for {date})")
             else:
@@ -291,7 +377,8 @@ def filter_out_old_rpms(rpms_dir, old_rpms, rpms_list):
 
 def _apply_date_old_rpms(rpms_dir, old_rpms, section, section_tag, do_it):
     config = old_rpms['lst']
-    for pkg in config[section]:
+    # do_it may delete the entry, iterate over a copy of the names
+    for pkg in list(config[section]):
         date = config[section][pkg]
         if os.path.exists(os.path.join(rpms_dir, pkg)):
             if int(date) >= int(time.time()):
@@ -312,35 +399,101 @@ def filter_existing_hdlist(rpms_todo, in_hdlist, out, sizes):
         nb = 0
         print(f"parse_hdlist has failed, keeping {nb} headers successfully parsed")
 
-def add_new_rpms_to_hdlist(rpms_todo, out, rpms_dir, xml_media_info, xml_info_suffix):
+def add_new_rpms_to_hdlist(rpms_todo, out, rpms_dir, xml_media_info, header_cache=None, clean=False):
     rpms_dir = Path(rpms_dir)
-
-    for rpm in rpms_todo:
-        rpm_path = rpms_dir / rpm
-        if rpm_path.exists():
-            with rpm_path.open("rb") as rpm_file:
-                rpm_header = get_rpm_info(rpm_file)
-
-                # create hdlist entry
-                hdlist_entry = out["hdlist"].add_pkg(rpm_header, rpm_file)
+    rpm_paths = [rpms_dir / rpm for rpm in rpms_todo if (rpms_dir / rpm).exists()]
+    keys = [header_cache_key(rpm_path) for rpm_path in rpm_paths]
+
+    # parsed headers of the previous runs, a new cache is started with --clean
+    cache = load_header_cache(header_cache) if header_cache and not clean else {}
+    # only the current rpms are kept, the cache is rewritten on each run
+    new_cache = {}
+    missing = [rpm_path for rpm_path, key in zip(rpm_paths, keys) if key not in cache]
+    # headers are parsed in worker processes, but added in order to keep the hdlist deterministic
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("fork")) as executor:
+        parsed = executor.map(get_rpm_info, missing, chunksize=16)
+        for rpm_path, key in zip(rpm_paths, keys):
+            package_info = cache[key] if key in cache else next(parsed)
+            new_cache[key] = package_info
+            # create hdlist entry, from a copy as add_pkg_prepared splits the dict
+            out["hdlist"].add_pkg_prepared(rpm_path.name, dict(package_info))
+    # the file holds every header, don't rewrite it when no rpm changed
+    if header_cache and new_cache.keys() != cache.keys():
+        save_header_cache(header_cache, new_cache)
+    # the cache holds references to the headers, release them with the hdlist
+    del cache, new_cache
+
+    # write hdlist first, this frees the headers before the other passes
+    out["hdlist"].write()
 
     # write synthesis
     out["hdlist"].write_synthesis()
-    for xml_info in xml_media_info:
-        print(f"writing {xml_info}")
-        out["hdlist"].write_xml(xml_info, xml_info_suffix)
+    # the XML files don't share any data and lzma releases the GIL, threads are enough
+    with ThreadPoolExecutor(max_workers=len(xml_media_info) or 1) as executor:
+        futures = []
+        for xml_info in xml_media_info:
+            print(f"writing {xml_info}")
+            futures.append(executor.submit(out["hdlist"].write_xml, xml_info))
+        for future in futures:
+            # raise the errors of the writers, if any
+            future.result()
+
+def default_header_cache(rpms_dir):
+    # out of media_info, which is published: one file per rpms directory in the user cache
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    name = hashlib.md5(os.path.realpath(rpms_dir).encode("utf-8")).hexdigest()
+    return cache_home / "upanier" / f"{name}.headers"
+
+def load_header_cache(file):
+    try:
+        with open(file, 'rb', buffering=BUFSIZE) as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        print(f"ignoring unreadable header cache {file}: {e}")
+        return {}
+    # entries written by another version of get_package_info may not have the same fields
+    if not isinstance(data, dict) or data.get('version') != PACKAGE_INFO_VERSION:
+        print(f"ignoring header cache {file} from another version")
+        return {}
+    return data['entries']
+
+def save_header_cache(file, cache):
+    # written aside then renamed, an interrupted run leaves the previous cache,
+    # and the temporary name is unique so that concurrent runs don't mix their writes
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=file.parent, prefix=f"{file.name}.", delete=False, buffering=BUFSIZE) as f:
+        try:
+            pickle.dump({'version': PACKAGE_INFO_VERSION, 'entries': cache}, f, protocol=5)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, file)
 
-    # write hdlist
-    out["hdlist"].write()
+def header_cache_key(rpm_path):
+    # a rebuilt rpm with the same name has another size or mtime
+    st = rpm_path.stat()
+    return f"{rpm_path.name}|{st.st_size}|{st.st_mtime_ns}"
+
+_TS = None
 
-def get_rpm_info(rpm_file):
-    # Initialize the RPM transaction set
-    ts = rpm.TransactionSet()
+def transaction_set():
+    # one transaction set per process, it is costly to create and can be reused
+    global _TS
+    if _TS is None:
+        _TS = rpm.TransactionSet()
+        # we only read headers for the hdlist, digests and signatures are not checked
+        _TS.setVSFlags(rpm.RPMVSF_MASK_NODIGESTS | rpm.RPMVSF_MASK_NOSIGNATURES)
+    return _TS
 
+def get_rpm_info(rpm_path):
     # Open the RPM file
     # Extract the RPM package header
-    hdr = ts.hdrFromFdno(rpm_file)
-    return hdr
+    with open(rpm_path, "rb") as rpm_file:
+        hdr = transaction_set().hdrFromFdno(rpm_file)
+    # the header itself can't be pickled, return the extracted fields instead
+    return get_package_info(hdr)
 
 if __name__ == "__main__":
     main()
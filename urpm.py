@@ -1,49 +1,231 @@
 #!/usr/bin/python3
+import io
 import lzma
 import gzip
+import zlib
 import rpm
 import os
 import sys
 import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from contextlib import contextmanager
 from shutil import copyfileobj, rmtree
-from typing import IO, Any, Iterator, List, Tuple, ByteString
-from struct import unpack, pack
+from typing import IO, Any, Deque, Iterator, List, Tuple, ByteString
+from struct import Struct
 from pathlib import Path
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# I/O buffer size used for every compressed file we write or read
+BUFSIZE = 256 * 1024
+
+# coff, csize, off and size of each file in the hdlist TOC
+_TOC_ENTRY = Struct(">4i")
+# header, number of dirs, symlinks and files, TOC length, uncompress command, footer
+_TOC_TRAILER = Struct(">4s4i40s4s")
+
+
+def parse_filter(filter: str) -> Tuple[str, str, int]:
+    # filter is in the form .suffix:tool -level, e.g. .cz:xz -7
+    try:
+        suffix, command = filter.split(":")
+        tool, level = command.split(" ")[:2]
+        preset = - int(level.removesuffix("e"))
+    except ValueError:
+        raise Exception(f"Invalid filter {filter}")
+    # a trailing 'e' (e.g. xz -7e) selects the extreme xz preset
+    if tool == "xz" and level.endswith("e"):
+        preset |= lzma.PRESET_EXTREME
+    return suffix, tool, preset
+
+
+@contextmanager
+def _open_compressed(path: Path, tool: str, level: int) -> Iterator[IO]:
+    with open(path, 'wb', buffering=BUFSIZE) as raw:
+        if tool == "xz":
+            # explicit LZMA2 filter chain, same output as the preset alone
+            filters = [{'id': lzma.FILTER_LZMA2, 'preset': level}]
+            f = lzma.LZMAFile(raw, 'wb', format=lzma.FORMAT_XZ, filters=filters)
+        elif tool == "gzip":
+            f = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+        else:
+            # threads=-1 lets zstd compress on all the cores
+            f = zstandard.ZstdCompressor(level=level, threads=-1).stream_writer(raw, closefd=False)
+        # binary mode, the writers encode their data themselves
+        with f:
+            yield f
+
+
+@contextmanager
+def _open_decompressed(path: Path, tool: str) -> Iterator[IO]:
+    # text mode counterpart of _open_compressed, for reading media info back
+    with open(path, 'rb', buffering=BUFSIZE) as raw:
+        if tool == "xz":
+            f = lzma.LZMAFile(raw, 'rb')
+        elif tool == "gzip":
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+        else:
+            f = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        # closing the text layer closes the decompressor, raw is closed by the outer with
+        with io.TextIOWrapper(f, encoding="utf-8") as text:
+            yield text
+
+
+def _compress_block(chunks: List[ByteString], filter: str, level: int) -> bytes:
+    # runs in a worker process, so it must not depend on any Pack state
+    if filter == "gzip":
+        # wbits=31 lets zlib write the gzip header and CRC32/ISIZE trailer itself
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    else:
+        compressor = lzma.LZMACompressor(preset=level)
+    # the headers are fed one by one, they are never concatenated in a block buffer
+    cdata = [compressor.compress(chunk) for chunk in chunks]
+    cdata.append(compressor.flush())
+    return b"".join(cdata)
+
+
+# package_info fields read as is from the rpm header
+_SCALAR_TAGS = (
+    ('name', rpm.RPMTAG_NAME),
+    ('epoch', rpm.RPMTAG_EPOCH),
+    ('version', rpm.RPMTAG_VERSION),
+    ('release', rpm.RPMTAG_RELEASE),
+    ('architecture', rpm.RPMTAG_ARCH),
+    ('summary', rpm.RPMTAG_SUMMARY),
+    ('description', rpm.RPMTAG_DESCRIPTION),
+    ('group', rpm.RPMTAG_GROUP),
+    ('license', rpm.RPMTAG_LICENSE),
+    ('packager', rpm.RPMTAG_PACKAGER),
+    ('buildtime', rpm.RPMTAG_BUILDTIME),
+    ('sourcerpm', rpm.RPMTAG_SOURCERPM),
+    ('url', rpm.RPMTAG_URL),
+    ('filesize', rpm.RPMTAG_LONGSIGSIZE),
+    ('size', rpm.RPMTAG_SIZE),
+    ('changelogtext', rpm.RPMTAG_CHANGELOGTEXT),
+    ('changelogname', rpm.RPMTAG_CHANGELOGNAME),
+    ('changelogtime', rpm.RPMTAG_CHANGELOGTIME),
+)
+
+# package_info dependency fields with their name, version and flags tags
+_DEP_TAGS = (
+    ('requires', rpm.RPMTAG_REQUIRES, rpm.RPMTAG_REQUIREVERSION, rpm.RPMTAG_REQUIREFLAGS),
+    # this could be claryfied. Are recommends and suggests equivalent or used simultaneously
+    ('suggests', rpm.RPMTAG_RECOMMENDS, rpm.RPMTAG_RECOMMENDVERSION, rpm.RPMTAG_RECOMMENDFLAGS),
+    ('conflicts', rpm.RPMTAG_CONFLICTS, rpm.RPMTAG_CONFLICTVERSION, rpm.RPMTAG_CONFLICTFLAGS),
+    ('obsoletes', rpm.RPMTAG_OBSOLETES, rpm.RPMTAG_OBSOLETEVERSION, rpm.RPMTAG_OBSOLETEFLAGS),
+    ('provides', rpm.RPMTAG_PROVIDES, rpm.RPMTAG_PROVIDEVERSION, rpm.RPMTAG_PROVIDEFLAGS),
+)
+
+
+_SENSE_MASK = rpm.RPMSENSE_LESS | rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL
+
+# version constraint for each combination of the sense flags, as urpmi expects them
+_CONSTRAINT = {
+    0: "",
+    rpm.RPMSENSE_LESS: "<",
+    rpm.RPMSENSE_GREATER: ">",
+    rpm.RPMSENSE_EQUAL: "==",
+    rpm.RPMSENSE_LESS | rpm.RPMSENSE_EQUAL: "<=",
+    rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL: ">=",
+    rpm.RPMSENSE_LESS | rpm.RPMSENSE_GREATER: ">",
+    rpm.RPMSENSE_LESS | rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL: ">=",
+}
+
+
+_DEP_FIELDS = tuple(field for field, *_ in _DEP_TAGS)
+
+
+def _extract_scalar_tags(hdr: Any) -> dict:
+    return {field: hdr[tag] for field, tag in _SCALAR_TAGS}
+
+
+# version of the dict returned by get_package_info, stored with the header cache:
+# bump it whenever get_package_info changes
+PACKAGE_INFO_VERSION = 1
+
+
+def get_package_info(hdr: Any) -> dict:
+    # Get basic package information
+    package_info = _extract_scalar_tags(hdr)
+    if package_info['epoch'] is None:
+        package_info['epoch'] = 0
+    # 440 is the rpm header size (?) empirical, but works 
+    package_info['filesize'] += 440
+
+    # Get files in the RPM package, only the names as rpm.fi objects can't be pickled
+    package_info['files'] = [file[0] for file in hdr.fiFromHeader()]
+    # Package dependencies (if any)
+    for field, names_tag, versions_tag, flags_tag in _DEP_TAGS:
+        names = hdr[names_tag]
+        if names:
+            package_info[field] = print_list_entry(names, hdr[versions_tag], hdr[flags_tag])
+    package_info['header'] = hdr.unload()
+    return package_info
+
+
+def print_list_entry(names: List[str], versions: List[str], flags: List[int]) -> List[str]:
+    reqs = []
+    for name, version, flag in zip(names, versions, flags):
+        if not name.startswith('rpmlib('):
+            reqs.append(f"{name}[{_CONSTRAINT[flag & _SENSE_MASK]} {version}]" if version else name)
+    return reqs
+
 
 class Pack:
     def __init__(self,
             archive: IO,
             synthesis_path: IO,
-            filter: bytes = b"gzip",
+            filter: Tuple[str, str, int] = (".cz", "gzip", 9),
+            synthesis_filter: Tuple[str, str, int] = (".cz", "xz", 7),
+            xml_info_filter: Tuple[str, str, int] = (".lzma", "xz", 7),
             uncompress: bytes = b"", 
             extern: bool = False, 
             noargs: bool = False, 
             block_size: int = 400 * 1024, 
-            bufsize: int = 65536, 
+            bufsize: int = 1 << 20, 
             quiet: bool = False, 
-            debug: bool = False)-> None:
+            debug: bool = False,
+            jobs: int = 0)-> None:
         
-        self.destroyed: bool = False
+        # nothing to finish in __del__ if the arguments are rejected below
+        self.destroyed: bool = True
         self.filename = archive
-        try:
-            self.filter = filter.decode("utf-8").split(":")[1].split(" ")[0]
-            self.level = - int(filter.decode("utf-8").split(":")[1].split(" ")[1])
-        except ValueError:
-            raise Exception(f"Invalid hdlist filter {hdlist_filter}")
+        # filters are (suffix, tool, level) as returned by parse_filter
+        _, self.filter, self.level = filter
         if self.filter not in ["gzip", "xz"]:
             raise Exception(f"Invalid hdlist filter {self.filter}, it should be 'gzip' or 'xz'")
+        # command stored in the TOC, even for an hdlist without any block
+        self.uncompress = b"gzip -d" if self.filter == "gzip" else b"xz -d"
+        _, self.synthesis_filter, self.synthesis_level = synthesis_filter
+        self.xml_info_suffix, self.xml_info_filter, self.xml_info_level = xml_info_filter
+        for tool in (self.synthesis_filter, self.xml_info_filter):
+            if tool not in ["gzip", "xz", "zstd"]:
+                raise Exception(f"Invalid filter {tool}, it should be 'gzip', 'xz' or 'zstd'")
+            if tool == "zstd" and zstandard is None:
+                raise Exception("zstd compression requires the zstandard module")
         self.force_extern = extern
         self.noargs = noargs
         self.block_size = block_size
         self.bufsize = bufsize
+        # number of worker processes compressing hdlist blocks, 0 means one per core
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor: Any = None
+        self.pending_blocks: Deque = deque()
+        # uncompressed size of all the headers, used to preallocate the hdlist
+        self.total_insize: int = 0
+        self.preallocated: bool = False
 
         self.files: dict = {}
         self.dir: dict = {}
         self.symlink: dict = {}
         self.coff: int = 0
-        self.current_block_data: ByteString = b""
+        # headers of the current block, handed as is to the compressor
+        self.current_block_data: List[ByteString] = []
         self.current_block_files: List = []
         self.current_block_csize: int = 0
         self.current_block_coff: int = 0
@@ -55,209 +237,152 @@ class Pack:
         self.log: Any = (lambda *args: print(*args)) if quiet else (lambda *args: print(*args, file=sys.stderr))
         self.debug: Any = (lambda *args: print(*args)) if debug else (lambda *args: None)
         self.file_path = synthesis_path
-        self.synthesis = {}
+        # package data is split by the pass that uses it, so that each writer
+        # only walks its own dict and the headers can be freed once written
+        self.headers: dict = {}
+        self.deps: dict = {}
+        self.info: dict = {}
         self.order = 0
         # fixed temporary directory for now
         # self.temp_dir = tempfile.mkdtemp(prefix='my_temp_dir_')
         self.temp_dir = synthesis_path.parent
         self.temp_dir.mkdir(exist_ok=True)
-        self.handle: IO  = open(self.filename, 'wb')
+        self.handle: IO  = open(self.filename, 'wb', buffering=self.bufsize)
+        self.destroyed = False
 
 
     def read_synthesis(self):
-        with lzma.open(self.file_path, 'rt') as f:
-            lines = f.readlines()
         hdlist_dict = {}
         current_name = None
         current_entry = {}
-        for line in lines:
-            if line[0] == '@':
-                words = line[1:].strip().split('@')
-                if words[0] == "info":
-                    current_entry["epoch"] = words[2]
-                    current_entry["size"] = words[3]
-                    current_entry["group"] = words[4]
-                    hdlist_dict[words[1]] = current_entry
-                    #current_name = words[1]
-                    current_entry = {}
-                else:
-                    current_entry[words[0]] = words[1:]
-        self.synthesis = hdlist_dict
+        # the synthesis is parsed while it is decompressed, it is never loaded as a whole
+        with _open_decompressed(self.file_path, self.synthesis_filter) as f:
+            for line in f:
+                if line[0] == '@':
+                    words = line[1:].strip().split('@')
+                    if words[0] == "info":
+                        current_entry["epoch"] = words[2]
+                        current_entry["size"] = words[3]
+                        current_entry["group"] = words[4]
+                        hdlist_dict[words[1]] = current_entry
+                        #current_name = words[1]
+                        current_entry = {}
+                    else:
+                        current_entry[words[0]] = words[1:]
+        for name, entry in hdlist_dict.items():
+            self.deps[name] = {field: value for field, value in entry.items() if field in _DEP_FIELDS}
+            self.info[name] = {field: value for field, value in entry.items() if field not in _DEP_FIELDS}
         return hdlist_dict
 
     def write_synthesis(self):
-        data = ''
-        fields = ("requires","suggests","obsoletes","conflicts","provides","summary","filesize")
-        for name, entry in self.synthesis.items():
-            for field in fields:
-                if field in entry.keys():
-                    if isinstance(entry[field], list):
-                        if len(entry[field]) > 0:
-                            data += f"@{field}@{'@'.join(entry[field])}\n"
-                    else:
-                        data += f"@{field}@{'@'.join(str(x)  if isinstance(x, int)  else x for x in entry[field])}\n" if isinstance(entry[field], list)  else f"@{field}@{entry[field]}\n" 
-            data += f"@info@{name.removesuffix('.rpm')}@{entry['epoch']}@{entry['size']}@{entry['group']}\n"
-        with lzma.open(self.temp_dir / 'synthesis.hdlist.cz', 'wt') as f:
-            f.write(data)
-
-    def _write_files(self):
-        data =  '<?xml version="1.0" encoding="utf-8"?>\n<media_info>'
-        for name, entry in self.synthesis.items():
-            data += f'<files fn="{name}">\n'
-            if 'files' in entry.keys():
+        dep_fields = ("requires","suggests","obsoletes","conflicts","provides")
+        info_fields = ("summary","filesize")
+        # each package is written as soon as it is formatted, the whole synthesis is never held in memory
+        with _open_compressed(self.file_path, self.synthesis_filter, self.synthesis_level) as f:
+            for name, info in self.info.items():
+                deps = self.deps[name]
+                parts = [f"@{field}@{'@'.join(deps[field])}\n" for field in dep_fields if deps.get(field)]
+                for field in info_fields:
+                    if field in info:
+                        value = info[field]
+                        if isinstance(value, list):
+                            if value:
+                                parts.append(f"@{field}@{'@'.join(value)}\n")
+                        else:
+                            parts.append(f"@{field}@{value}\n")
+                parts.append(f"@info@{name.removesuffix('.rpm')}@{info['epoch']}@{info['size']}@{info['group']}\n")
+                f.write("".join(parts).encode("utf-8"))
+
+    def _write_files(self, f: IO):
+        f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<media_info>')
+        for name, entry in self.info.items():
+            parts = [f'<files fn="{name}">\n']
+            if 'files' in entry:
                 for file in entry['files']:
-                    data += file[0]+ "\n"
-            data += '</files>\n'
-        data += '</media_info>'
-        return data
+                    parts.append(file + "\n")
+            parts.append('</files>\n')
+            f.write("".join(parts).encode("utf-8"))
+        f.write(b'</media_info>')
     
 
-    def _write_info(self):
-        data =  '<?xml version="1.0" encoding="utf-8"?>\n<media_info>'
-        for name, entry in self.synthesis.items():
-            if 'sourcerpm' not in entry.keys():
+    def _write_info(self, f: IO):
+        f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<media_info>')
+        for name, entry in self.info.items():
+            if 'sourcerpm' not in entry:
                 print(f"Missing sourcerpm for {entry}")
                 sys.exit(1)
-            data += f"<info fn='{name}'\n sourcerpm='{entry['sourcerpm']}'\n url='{entry['url']}'\n license='{entry['license']}' >\n"
-            data += entry["description"]           
-            data += '</info>\n'
-        data += '</media_info>'
-        return data
-
-    def _write_changelog(self):
-        data =  '<?xml version="1.0" encoding="utf-8"?>\n<media_info>'
-        for name, entry in self.synthesis.items():
-            data += f"<changelogs fn='{name}'>\n"
-            for i in range(0, len(entry["changelogname"])):
-                data += f"<log time='{entry['changelogtime'][i]}'>\n<log_name>{entry['changelogname'][i]}</log_name>\n<log_text>{entry['changelogtext'][i]}</log_text>\n</log>\n"
-            data += '</info>\n'
-        data += '</media_info>'
-        return data
-
-    def write_xml(self, xml_info: str, xml_info_suffix: ByteString):
-        if xml_info == 'files':
-            data = self._write_files()
-        if xml_info == 'info':
-            data = self._write_info()
-        if xml_info == 'changelog':
-            data = self._write_changelog()
-        with lzma.open((self.temp_dir / xml_info).with_suffix(".xml" +xml_info_suffix.decode('utf-8')), 'wt') as f:
-            f.write(data)
+            f.write(f"<info fn='{name}'\n sourcerpm='{entry['sourcerpm']}'\n url='{entry['url']}'\n license='{entry['license']}' >\n"
+                    f"{entry['description']}</info>\n".encode("utf-8"))
+        f.write(b'</media_info>')
+
+    def _write_changelog(self, f: IO):
+        f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<media_info>')
+        for name, entry in self.info.items():
+            parts = [f"<changelogs fn='{name}'>\n"]
+            for time, log_name, text in zip(entry['changelogtime'], entry['changelogname'], entry['changelogtext']):
+                parts.append(f"<log time='{time}'>\n<log_name>{log_name}</log_name>\n<log_text>{text}</log_text>\n</log>\n")
+            parts.append('</info>\n')
+            f.write("".join(parts).encode("utf-8"))
+        f.write(b'</media_info>')
+
+    def write_xml(self, xml_info: str):
+        writers = {
+            'files': self._write_files,
+            'info': self._write_info,
+            'changelog': self._write_changelog,
+        }
+        xml_path = (self.temp_dir / xml_info).with_suffix(".xml" + self.xml_info_suffix)
+        with _open_compressed(xml_path, self.xml_info_filter, self.xml_info_level) as f:
+            writers[xml_info](f)
 
     def file_sizes(self, rpm_list: List=[]):
         if rpm_list == []:
-            return {name: data['filesize'] for (name, data) in self.synthesis.items() if 'filesize' in data.keys()}
+            return {name: data['filesize'] for (name, data) in self.info.items() if 'filesize' in data.keys()}
         else:
-            return {name: data['filesize'] for (name, data) in self.synthesis.items() if 'filesize' in data.keys() and name in rpm_list}
+            return {name: data['filesize'] for (name, data) in self.info.items() if 'filesize' in data.keys() and name in rpm_list}
     
     def write(self):
         self.current_block_off = 0
         self.current_block_coff = 0
-        for rpm in self.synthesis.keys():
-            self.current_block_files.append(rpm)
-            data = self.synthesis[rpm]['header']
-            length = len(data)
-            self.current_block_off += length
-            self.current_block_data += data
-            self.files[rpm] = {
-                'size': length,
-                'off': self.current_block_off,
-                'csize': -1,
-                'coff': self.current_block_coff,
-            }
-            if len(self.current_block_data) >= self.block_size:
-                self.end_block()
-        self.end_block()
-        self.build_toc()
+        self.total_insize = sum(map(len, self.headers.values()))
+        if self.jobs > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("fork"))
+        try:
+            for rpm, data in self.headers.items():
+                self.current_block_files.append(rpm)
+                length = len(data)
+                self.current_block_data.append(data)
+                self.files[rpm] = {
+                    'size': length,
+                    'off': self.current_block_off,
+                    'csize': -1,
+                    # set once the block is written, see write_block
+                    'coff': -1,
+                }
+                self.current_block_off += length
+                if self.current_block_off >= self.block_size:
+                    self.end_block()
+            self.end_block()
+            self.build_toc()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
         self.handle.close()
+        # the headers are only needed for the hdlist
+        self.headers.clear()
         self.destroyed = True
 
     def add_pkg(self, hdr:ByteString, rpm_file: IO):
-        
-        # Get basic package information
-        package_info = {
-            'name': hdr[rpm.RPMTAG_NAME],
-            'epoch': 0 if hdr[rpm.RPMTAG_EPOCH] == None else hdr[rpm.RPMTAG_EPOCH],
-            'version': hdr[rpm.RPMTAG_VERSION],
-            'release': hdr[rpm.RPMTAG_RELEASE],
-            'architecture': hdr[rpm.RPMTAG_ARCH],
-            'summary': hdr[rpm.RPMTAG_SUMMARY],
-            'description': hdr[rpm.RPMTAG_DESCRIPTION],
-            'group': hdr[rpm.RPMTAG_GROUP],
-            'license': hdr[rpm.RPMTAG_LICENSE],
-            'packager': hdr[rpm.RPMTAG_PACKAGER],
-            'buildtime': hdr[rpm.RPMTAG_BUILDTIME],
-            'sourcerpm': hdr[rpm.RPMTAG_SOURCERPM],
-            'url': hdr[rpm.RPMTAG_URL],
-            # 440 is the rpm header size (?) empirical, but works 
-            'filesize': hdr[rpm.RPMTAG_LONGSIGSIZE] + 440,
-            'size': hdr[rpm.RPMTAG_SIZE],
-            'changelogtext': hdr[rpm.RPMTAG_CHANGELOGTEXT],
-            'changelogname': hdr[rpm.RPMTAG_CHANGELOGNAME],
-            'changelogtime': hdr[rpm.RPMTAG_CHANGELOGTIME],
-        }
+        self.add_pkg_prepared(os.path.basename(rpm_file.name), get_package_info(hdr))
 
-        # Get files in the RPM package
-        files = hdr.fiFromHeader()
-        package_info['files'] = files
-        # Package dependencies (if any)
-        if hdr.requires != []:
-            package_info['requires'] = self.print_list_entry(
-                hdr[rpm.RPMTAG_REQUIRES],
-                iter(hdr[rpm.RPMTAG_REQUIREVERSION]),
-                iter(hdr[rpm.RPMTAG_REQUIREFLAGS]),
-            )
-        # this could be claryfied. Are recommends and suggests equivalent or used simultaneously
-        if hdr.recommends != []:
-            package_info['suggests'] = self.print_list_entry(
-                hdr[rpm.RPMTAG_RECOMMENDS],
-                iter(hdr[rpm.RPMTAG_RECOMMENDVERSION]),
-                iter(hdr[rpm.RPMTAG_RECOMMENDFLAGS]),
-            )
-        if hdr.conflicts != []:
-            package_info['conflicts'] = self.print_list_entry(
-                hdr[rpm.RPMTAG_CONFLICTS],
-                iter(hdr[rpm.RPMTAG_CONFLICTVERSION]),
-                iter(hdr[rpm.RPMTAG_CONFLICTFLAGS]),
-                )
-        if hdr.obsoletes != []: 
-            package_info['obsoletes'] = self.print_list_entry(
-                hdr[rpm.RPMTAG_OBSOLETES],
-                iter(hdr[rpm.RPMTAG_OBSOLETEVERSION]),
-                iter(hdr[rpm.RPMTAG_OBSOLETEFLAGS]),
-                )    
-        if hdr.provides != []: 
-            package_info['provides'] = self.print_list_entry(
-                hdr[rpm.RPMTAG_PROVIDES],
-                iter(hdr[rpm.RPMTAG_PROVIDEVERSION]),
-                iter(hdr[rpm.RPMTAG_PROVIDEFLAGS])
-                )
+    def add_pkg_prepared(self, name: str, package_info: dict):
+        # package_info comes from get_package_info, possibly computed in another process
         self.order += 1
         package_info['order'] = self.order
-        package_info['header'] = hdr.unload()
-
-        self.synthesis[os.path.basename(rpm_file.name)] = package_info
-
-    def print_list_entry(self, names: List[str], versions: List[str], flags: List[int]) -> List[str]:
-        reqs = []
-        for name in names:
-            version = next(versions)
-            flag = next(flags)
-            if not name.startswith('rpmlib('):
-                if version != "":
-                    constraint = ""
-                    if (flag & rpm.RPMSENSE_LESS):
-                        constraint = '<'
-                    if (flag & rpm.RPMSENSE_GREATER):
-                        constraint = '>'
-                    if (flag & rpm.RPMSENSE_EQUAL):
-                        constraint += '='
-                    if ((flag & (rpm.RPMSENSE_LESS|rpm.RPMSENSE_EQUAL|rpm.RPMSENSE_GREATER)) == rpm.RPMSENSE_EQUAL):
-                        constraint = '=='
-                    reqs.append(f"{name}[{constraint} {version}]")
-                else:
-                    reqs.append(name)
-        return reqs
+        self.headers[name] = package_info.pop('header')
+        self.deps[name] = {field: package_info.pop(field) for field in _DEP_FIELDS if field in package_info}
+        self.info[name] = package_info
 
 
     def __del__(self) -> None:
@@ -273,68 +398,93 @@ class Pack:
         if not self.need_build_toc:
             return True
         self.end_block()
+        self.flush_blocks()
         self.end_seek()
-        toc_length = 0
-
-        coff = self.coff
-        toc_sizes_offsets = b""
 
-        toc_str = b""
+        # names of the directories, symlinks and files, followed by the sizes and offsets of the files
+        toc = bytearray()
         for entry in self.dir:
-            toc_str += entry + b"\n"
-            toc_length += len(entry + "\n")
+            toc += entry + b"\n"
         for entry, link in self.symlink.items():
-            toc_str += entry + b"\n" + link + b"\n"
-            toc_length += len(entry + "\n" + link + "\n")
-        for entry in sorted(self.files.keys()):
-            toc_length += len(entry + "\n")
-        for entry in sorted(self.files.keys()):
-            coff, csize, off, size = self.files[entry].values()
-            toc_str += entry.encode("utf-8") + b"\n"
-            toc_sizes_offsets += pack(">4i", coff, csize, off, size)
-            toc_length += len(pack(">4i", coff, csize, off, size))
+            toc += entry + b"\n" + link + b"\n"
+        files = sorted(self.files.keys())
+        toc_sizes_offsets = bytearray(_TOC_ENTRY.size * len(files))
+        for i, entry in enumerate(files):
+            file = self.files[entry]
+            toc += entry.encode("utf-8") + b"\n"
+            _TOC_ENTRY.pack_into(toc_sizes_offsets, i * _TOC_ENTRY.size, file['coff'], file['csize'], file['off'], file['size'])
+        toc_length = len(toc) + len(toc_sizes_offsets)
 
-        self.coff += toc_length
         toc_header = b"cz[0"
         toc_footer = b"0]cz"
-        toc_str += pack(b">4s4i40s4s", toc_header, len(self.dir), len(self.symlink), len(self.files), toc_length, self.uncompress, toc_footer)
-        self.handle.seek(self.coff, os.SEEK_SET)
-        self.handle.write(toc_str)
+        trailer = _TOC_TRAILER.pack(toc_header, len(self.dir), len(self.symlink), len(self.files), toc_length, self.uncompress, toc_footer)
+        # the TOC starts right after the last block, written with a single call
+        self.handle.write(toc + toc_sizes_offsets + trailer)
+        # drop what was preallocated beyond the end of the hdlist
+        self.handle.truncate()
+        self.coff += toc_length
         self.toc_f_count = len(self.files)
         return True
 
 
+    def preallocate(self, size: int):
+        self.preallocated = True
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(self.handle.fileno(), 0, size)
+        except OSError as e:
+            # not supported by every filesystem, this is only an optimization
+            self.debug(f"cannot preallocate {self.filename}: {e}")
+
     def end_seek(self):
         seekvalue = self.coff
         r = self.handle.seek(seekvalue, os.SEEK_SET)
         return r == seekvalue
 
     def end_block(self):
-        print(f"writing block with {len(self.current_block_data)} bytes")
-        if not self.end_seek():
+        # write() then build_toc() both end the last block, don't write an empty one
+        if not self.current_block_files:
             return
-        insize = len(self.current_block_data)
-        if self.filter == "gzip":
-            import io
-            self.uncompress = b"gzip -d"
-            # Créating objet io.BytesIO for storing data to compress
-            buf = io.BytesIO()
-            with gzip.GzipFile(fileobj=buf, mode='w', compresslevel=self.level) as gzip_file:
-                gzip_file.write(self.current_block_data)
-            cdata = buf.getvalue()
-        elif self.filter == "xz":
-            cdata = lzma.compress(self.current_block_data, preset=self.level)
-            self.uncompress = b"xz -d"
+        insize = sum(map(len, self.current_block_data))
+        self.debug(f"writing block with {insize} bytes")
+        args = (self.filter, self.level)
+        if self.executor is not None:
+            future = self.executor.submit(_compress_block, self.current_block_data, *args)
+        else:
+            future = Future()
+            future.set_result(_compress_block(self.current_block_data, *args))
+        self.pending_blocks.append((future, self.current_block_files, insize))
+        self.current_block_files = []
+        self.current_block_off = 0
+        # a new list, the executor may not have pickled the previous one yet
+        self.current_block_data = []
+        # keep the pool busy without holding every compressed block in memory
+        while len(self.pending_blocks) > 2 * self.jobs:
+            self.write_block()
+
+    def flush_blocks(self):
+        while self.pending_blocks:
+            self.write_block()
+
+    def write_block(self):
+        # blocks are written in submission order so that the offsets match the TOC
+        future, block_files, insize = self.pending_blocks.popleft()
+        cdata = future.result()
+        # blocks are written sequentially, no need to seek
+        assert self.handle.tell() == self.coff
         outsize = len(cdata)
+        self.debug(f"block of {insize} bytes compressed to {outsize} bytes")
         self.handle.write(cdata)
-        for fname in self.current_block_files:
-            self.files[fname]["csize"] = self.current_block_csize
+        if not self.preallocated and insize:
+            # estimate the final size from the compression ratio of the first block
+            self.preallocate(self.total_insize * outsize // insize)
         self.current_block_csize += outsize
+        for fname in block_files:
+            self.files[fname]["csize"] = self.current_block_csize
+            self.files[fname]["coff"] = self.current_block_coff
         self.coff += self.current_block_csize
         self.current_block_coff += self.current_block_csize
         self.current_block_csize = 0
-        self.current_block_files = []
-        self.current_block_off = 0
-        self.current_block_data = b""
 
 __version__ = "0.1.0"